@@ -5,10 +5,8 @@ __version__ = '0.1'
 __author__ = 'Zack Buschmann <zack@slac.stanford.edu>'
 
 
-from numpy import nan, array, ndarray, floor, sign, roll, vstack
+from numpy import nan, empty, floor, concatenate, copyto
 from subprocess import check_output
-from threading import Lock
-from copy import deepcopy
 from warnings import warn
 
 from epics import get_pv
@@ -42,7 +40,31 @@ def ns_to_pulse_ID(ns):
     """ (for BSA PVs) retrieves the pulse ID from the lower 14 bits of the nanoseconds field """
     return int(ns & 0x1ffff)
 
-def _push_to_ring_buffer(B, value): B = roll(B, -1); B[-1] = value; return B
+
+def _stream_kernel(buf, head, value, jump):
+    # hot path of _stream: NaN-pad any missed pulses, store the new value,
+    # and return the advanced head index
+    # the common jump <= 0 case is a single scalar store, pads coalesce into
+    # at most two slice assignments (the second covers the wraparound)
+    N = buf.shape[0]
+    if jump > 0:
+        end = head + min(jump, N)
+        if end <= N:
+            buf[head:end] = nan
+        else:
+            buf[head:] = nan
+            buf[:end - N] = nan
+        head = end % N
+    buf[head] = value
+    return (head + 1) % N
+
+# the kernel runs on every PV callback (up to 120Hz per channel), so compile it
+# with numba when available and fall back to the plain-python version if not
+try:
+    from numba import njit
+    _stream_kernel = njit(cache=True)(_stream_kernel)
+except ImportError:
+    pass
 
 
 class BSAStreamBuffer():
@@ -71,7 +93,13 @@ class BSAStreamBuffer():
     def __init__(self, channel, beamline, silence=False):
         self._channel, self._beamline = channel, beamline
         self._pv, self._pv_rate, self._pv_history = None, None, None
-        self._mutex = Lock()
+        # preallocate the ring buffer once, reinits refill it in place
+        self._buffer = empty(BSA_BUFFER_LENGTH)
+        self._buffer.fill(nan)
+        self._head = 0
+        self._history_suffix_used = None
+        self._reseed_needed = False
+        self._cb_stream, self._cb_rate = None, None
         self._silence = silence
         self._reinit(raise_errors=True)
 
@@ -81,41 +109,9 @@ class BSAStreamBuffer():
         # raise_errors=False allows (intermediate) undefined channel + beamline combos
         # so the user can reinit like so: s.beamline = 'SC_SXR'; s.channel = 'blahblah'
         try:
-            self._buffer = array(BSA_BUFFER_LENGTH)
-            if self._pv: self._pv.clear_callbacks()
-            self._pv = get_pv(f'{self.channel}', form='time')
-            self._pv.wait_for_connection()
-            self._pv.clear_callbacks()
-            self._pv_rate = get_pv(BEAM_RATE_PVS[self.beamline])
-            self._pv_rate.wait_for_connection()
-            self._pv_rate.clear_callbacks()
-            self._pv_rate.add_callback(self._rate_update)
-
-            # use whatever the fastest-populating edef is for the current beam rate
-            self._sample_rate = min(self._pv_rate.get(), MAX_BUFRATES[self.beamline[:2]])
-            self._rate_update(value=self._sample_rate)
-            suffix = '1H'
-            if self._sample_rate >= 10.0:
-                suffix = 'TH'
-            elif self._sample_rate >= MAX_BUFRATES[self.beamline[:2]]:
-                suffix = 'HH' if self.beamline[:2] == 'SC' else 'BR'
-            self._pv_history = get_pv(
-                f'{self.channel}{HISTORY_EDEFS[self.beamline]}{suffix}', form='time'
-                )
-            self._pv_history.wait_for_connection()
-
-            # initial population from history buffer, then connect callbacks to start stream
-            # mutex (hopefully) makes this happen in quick enough sequence to minimize missed shots
-            # TODO: determine if this does anything lol
-            with self._mutex:
-                v = self._pv_history.get_with_metadata()
-                self._p_latest = ns_to_pulse_ID(v['nanoseconds'])
-                self._p_prev = self._p_latest - self.ticks_per_sample
-                self._buffer = v['value']
-                self._pv.add_callback(self._stream)
-
-            self._pv_history.disconnect()
-
+            self._connect_stream_pv()
+            self._connect_rate_pv()
+            self._seed_from_history()
         except Exception as e:
             if raise_errors:
                 print(f'{self.beamline} BSAStreamBuffer init for {self.channel} failed')
@@ -123,38 +119,106 @@ class BSAStreamBuffer():
             else:
                 warn(f'Invalid BSAStreamBuffer definition: {self.beamline} {self.channel}')
 
+    def _connect_stream_pv(self):
+        # get_pv caches PV objects process-wide, so only this stream's own
+        # callback token is removed -- clear_callbacks/disconnect would break
+        # any other widget sharing the same PV
+        self._remove_stream_callback()
+        self._pv = get_pv(f'{self.channel}', form='time')
+        self._pv.wait_for_connection()
+
+    def _remove_stream_callback(self):
+        if self._pv and self._cb_stream is not None:
+            self._pv.remove_callback(self._cb_stream)
+        self._cb_stream = None
+
+    def _connect_rate_pv(self):
+        # forget the previous config's suffix so the synchronous _rate_update
+        # below can't flag a redundant re-seed before _reinit does its own
+        self._history_suffix_used = None
+        if self._pv_rate and self._cb_rate is not None:
+            self._pv_rate.remove_callback(self._cb_rate)
+        self._pv_rate = get_pv(BEAM_RATE_PVS[self.beamline])
+        self._pv_rate.wait_for_connection()
+        self._cb_rate = self._pv_rate.add_callback(self._rate_update)
+        self._sample_rate = min(self._pv_rate.get(), MAX_BUFRATES[self.beamline[:2]])
+        self._rate_update(value=self._sample_rate)
+
+    def _history_suffix(self):
+        # use whatever the fastest-populating edef is for the current beam rate
+        suffix = '1H'
+        if self._sample_rate >= 10.0:
+            suffix = 'TH'
+        elif self._sample_rate >= MAX_BUFRATES[self.beamline[:2]]:
+            suffix = 'HH' if self.beamline[:2] == 'SC' else 'BR'
+        return suffix
+
+    def _seed_from_history(self):
+        # initial population from history buffer, then connect callbacks to start stream
+        self._reseed_needed = False
+        suffix = self._history_suffix()
+        # do all the fallible CA work up front, before touching the live
+        # stream, so a timeout or bad read here degrades to "no re-seed"
+        # instead of leaving the stream callback removed and the plot frozen
+        self._pv_history = get_pv(
+            f'{self.channel}{HISTORY_EDEFS[self.beamline]}{suffix}', form='time'
+            )
+        if not self._pv_history.wait_for_connection():
+            raise RuntimeError(f'history PV connection timed out: {self._pv_history.pvname}')
+        v = self._pv_history.get_with_metadata()
+        if v is None or v.get('value') is None:
+            raise RuntimeError(f'history PV read failed: {self._pv_history.pvname}')
+        seed = v['value']
+        if len(seed) != BSA_BUFFER_LENGTH:
+            raise RuntimeError(f'bad history length {len(seed)}: {self._pv_history.pvname}')
+        p_latest = ns_to_pulse_ID(v['nanoseconds'])
+        # nothing below can fail, the live callback is only ever swapped out
+        # for a successfully read seed
+        self._remove_stream_callback()
+        self._p_latest = p_latest
+        self._p_prev = p_latest - self._ticks_int
+        self._buffer[:] = seed
+        self._head = 0
+        self._cb_stream = self._pv.add_callback(self._stream)
+        # no disconnect here: the history PV sits callback-free in the shared
+        # pyepics cache, and disconnecting could yank it from other streams
+        self._history_suffix_used = suffix
+
     def get_data(self):
         """ return array of 2800 data points and the pulse ID of the latest value """
-        return self._buffer, self._p_latest
+        # service any re-seed flagged by the rate monitor here, outside CA
+        # callback context, where blocking channel access is allowed
+        if self._reseed_needed:
+            self._reseed_needed = False
+            try:
+                self._seed_from_history()
+            except Exception:
+                warn(f'history re-seed failed: {self.beamline} {self.channel}')
+        # buffer is stored as a ring, rotate into chronological order only on request
+        head = self._head
+        return concatenate((self._buffer[head:], self._buffer[:head])), self._p_latest
 
     def _stream(self, value, nanoseconds, **kw):
-        # append the latest value to the stream buffer, if any pulses have been missed
-        # since the last update, they are padded with NaNs
-
-
-        
+        # write the latest value into the ring buffer at the current head position,
+        # if any pulses have been missed since the last update, they are padded with NaNs
         if not self._sample_rate: return
+        # bind repeated attributes to locals, each self.X is a dict lookup
+        # and this is the innermost per-pulse hot loop
+        ticks, p_prev = self._ticks_int, self._p_prev
         p_new = ns_to_pulse_ID(nanoseconds)
-        b = deepcopy(self._buffer)
-        p_expected = (self._p_prev + self.ticks_per_sample) % 2**14
-        jump = int((p_new - p_expected) / self.ticks_per_sample)
-        if jump > 0:
-            if not self._silence:
-                print(f'{self.channel} missed {jump} pulses: {self._p_prev}->{p_new}')
-            b = roll(b, -1*jump)
-            b[-1*jump:] = nan
-
-        # update to pulse ID and data buffer must be atomic to avoid sync errors
-        # otherwise it's possible to get a mismatch if _buffer or _p_latest are updated
-        # while get_data has actions on the stack
-        # TODO: determine if this does anything lol
-        with self._mutex:
-            self._buffer = _push_to_ring_buffer(b, value)
-            self._p_prev = self._p_latest
-            self._p_latest = p_new
-
-
-    
+        p_expected = (p_prev + ticks) & 0x3fff
+        jump = (p_new - p_expected) // ticks
+        if jump > 0 and not self._silence:
+            print(f'{self.channel} missed {jump} pulses: {p_prev}->{p_new}')
+
+        # attribute stores are atomic under the GIL, so publishing in order
+        # (buffer slots, then head, then pulse IDs) keeps get_data consistent
+        # without paying for a mutex acquire/release on every callback
+        self._head = _stream_kernel(self._buffer, self._head, value, jump)
+        self._p_prev = self._p_latest
+        self._p_latest = p_new
+
+
 
     def _rate_update(self, value, **kw):
         # updates current buffer sample rate and derived quantities
@@ -162,11 +226,22 @@ class BSAStreamBuffer():
         self._sample_spacing =   nan if not value else 1.0 / self._sample_rate
         self._ticks_per_sample = nan if not value else AC_FIDUCIAL_RATE / self._sample_rate
         self._buffer_modulus =   nan if not value else floor(2**14 / self._ticks_per_sample)
+        # integer tick increment for the callback hot path, keeps the pulse ID
+        # arithmetic in plain ints so the 2**14 modulo can be a bitmask
+        self._ticks_int = 0 if not value else int(AC_FIDUCIAL_RATE // self._sample_rate)
+        # a rate change can move the stream to a different history edef, but
+        # this runs inside the CA monitor callback where blocking channel
+        # access is forbidden -- just flag it, get_data does the re-seed
+        if self._history_suffix_used and self._history_suffix_used != self._history_suffix():
+            self._reseed_needed = True
 
     def stop(self):
-        for pv in [self._pv, self._pv_rate]:
-            pv.clear_callbacks()
-            pv.disconnect()
+        # remove only this stream's callbacks, the PV objects themselves are
+        # shared via the pyepics cache and may still be serving other streams
+        self._remove_stream_callback()
+        if self._pv_rate and self._cb_rate is not None:
+            self._pv_rate.remove_callback(self._cb_rate)
+        self._cb_rate = None
 
     @property
     def beamline(self): return self._beamline
@@ -183,7 +258,13 @@ class BSAStreamBuffer():
     @channel.setter
     def channel(self, value):
         self._channel = value
-        self._reinit()
+        # a channel change only touches the stream + history PVs, the rate PV
+        # for the current beamline stays connected
+        try:
+            self._connect_stream_pv()
+            self._seed_from_history()
+        except Exception:
+            warn(f'Invalid BSAStreamBuffer definition: {self.beamline} {self.channel}')
 
     @property
     def sample_rate(self): return self._sample_rate
@@ -227,6 +308,8 @@ class dualBSAStreamBuffer():
         self.__doc__ += f'\n{BSAStreamBuffer.__doc__}'
         self._ch1, self._ch2, self._beamline = ch1, ch2, beamline
         self._p_latest, self.N_pts_sync = -1, -1
+        # scratch array for synced data, get_data returns views of this
+        self._synced = empty((2, BSA_BUFFER_LENGTH))
         self._silence = silence
         self._reinit(raise_errors=True)
 
@@ -245,32 +328,44 @@ class dualBSAStreamBuffer():
                 warn('Invalid dualBSAStreamBuffer definition')
 
     def get_data(self):
-        """ returns a 2XM array, (M<=2800) of actual synchronized data & its latest pulse ID """
+        """
+        returns a 2XM array, (M<=2800) of actual synchronized data & its latest pulse ID
+        note: the returned array is a view of internal scratch storage,
+        it is only valid until the next call to get_data
+        """
         (b1,p1), (b2,p2) = self._s1.get_data(), self._s2.get_data()
 
         dp = p2 - p1
         self._p_latest = min(p1, p2)
-        if not dp: return vstack((b1,b2)), self._p_latest # already synced!
+        if not dp: # already synced!
+            self.N_pts_sync = BSA_BUFFER_LENGTH
+            copyto(self._synced[0], b1, casting='no')
+            copyto(self._synced[1], b2, casting='no')
+            return self._synced, self._p_latest
 
         # synchronize buffers b1 and b2 with last withnessed pulse IDs p1 and p2
         # pulse IDs count up to 2^14, check for rollover by
         # comparing the raw shot delta to a shifted one and take the minimum
         # i.e. when the raw delta equals the buffer modulus, the rollover delta is 0
-        # lag_direction = sign(dp)
+        # dp is a plain int (and nonzero here), so use scalar arithmetic for the
+        # lag direction rather than boxing through numpy.sign on every poll
         dshot_raw = int(dp / self.ticks_per_sample)
         dshot_rollover = int(dshot_raw - self.buffer_modulus)
-        shot_offset = sign(dp)*min(abs(dshot_raw), abs(dshot_rollover))
+        lag_direction = 1 if dp > 0 else -1
+        shot_offset = lag_direction*min(abs(dshot_raw), abs(dshot_rollover))
 
         # sync data by shifting buffers +/- by the shot offset
         # shot_offset > 0 means p1 lags p2 and vice-versa
         self.N_pts_sync = BSA_BUFFER_LENGTH - abs(shot_offset)
-        b_synced = ndarray((2, self.N_pts_sync))
+        # copyto with casting='no' takes the straight memcpy path, the row
+        # assignments otherwise re-run broadcasting/dtype checks per call
+        b_synced = self._synced[:, :self.N_pts_sync]
         if shot_offset > 0:
-            b_synced[0,:] = b1[shot_offset:]
-            b_synced[1,:] = b2[:self.N_pts_sync]
+            copyto(b_synced[0], b1[shot_offset:], casting='no')
+            copyto(b_synced[1], b2[:self.N_pts_sync], casting='no')
         elif shot_offset < 0:
-            b_synced[0,:] = b1[:self.N_pts_sync]
-            b_synced[1,:] = b2[-1*shot_offset:]
+            copyto(b_synced[0], b1[:self.N_pts_sync], casting='no')
+            copyto(b_synced[1], b2[-1*shot_offset:], casting='no')
 
         return b_synced, self._p_latest
 
@@ -292,16 +387,17 @@ class dualBSAStreamBuffer():
 
     @ch1.setter
     def ch1(self, value):
+        # the underlying stream reconnects itself, no need to rebuild both
+        self._ch1 = value
         self._s1.channel = value
-        self._reinit()
 
     @property
     def ch2(self): return self._s2.channel
 
     @ch2.setter
     def ch2(self, value):
+        self._ch2 = value
         self._s2.channel = value
-        self._reinit()
 
     @property
     def sample_rate(self): return self._s1.sample_rate
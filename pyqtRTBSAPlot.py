@@ -9,11 +9,26 @@ __author__ = 'Zack Buschmann <zack@slac.stanford.edu>'
 # TODO: add a median filter/moving average to time series plot
 
 
-from numpy import nanmean, nanstd, isfinite, linspace, polyfit, poly1d
-from numpy.fft import fft, fftfreq
+from numpy import nanmean, sqrt, isfinite, logical_and, count_nonzero, empty, array, arange, linspace, polyfit, poly1d
+from numpy.linalg import solve, LinAlgError
+# prefer pyFFTW (cached FFTW plans) or scipy (pocketfft) over numpy.fft, the FFT
+# mode transforms the same-size buffer every frame so plan reuse pays off
+try:
+    from pyfftw.interfaces import cache as _fftw_cache
+    from pyfftw.interfaces.numpy_fft import rfft, rfftfreq
+    _fftw_cache.enable()
+    FFT_BACKEND = 'pyfftw'
+except ImportError:
+    try:
+        from scipy.fft import rfft, rfftfreq
+        FFT_BACKEND = 'scipy'
+    except ImportError:
+        from numpy.fft import rfft, rfftfreq
+        FFT_BACKEND = 'numpy'
 from copy import deepcopy
 from PyQt5.QtCore import QTimer
 from PyQt5.QtGui import QColor
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsItem
 from pyqtgraph import PlotWidget, PlotCurveItem, ScatterPlotItem, LabelItem
 
 from epics import get_pv
@@ -25,6 +40,7 @@ warnings.filterwarnings('ignore', category=RuntimeWarning)
 
 
 DEFAULT_DRAW_INTERVAL = 100
+FFT_DRAW_INTERVAL = 500
 BSA_BUFFER_LENGTH = 2800
 FIT_LINE_NPTS = 500
 QCOL_R = QColor(255,0,0)
@@ -33,6 +49,45 @@ ANNOTATION_ALPHA = 0.75
 DATA_TEXT_POS = (0.075,0.01)
 FIT_TEXT_POS = (0.075,0.04)
 
+# shared shot-index axis, identical for every time plot so build it only once
+_T_AXIS = arange(BSA_BUFFER_LENGTH, dtype=float)
+_T_AXIS.setflags(write=False)
+
+
+def _fast_polyfit(x, y, order):
+    # closed-form least squares for the degree <= 2 fits the GUI offers,
+    # polyfit's Vandermonde + SVD machinery is overkill at these sizes
+    # coefficients are ordered highest degree first, same as numpy.polyfit
+    try:
+        if order == 1:
+            mx, my = x.mean(), y.mean()
+            dx = x - mx
+            slope = (dx*(y - my)).sum() / (dx*dx).sum()
+            coeffs = array([slope, my - slope*mx])
+        elif order == 2:
+            # demean x before forming the normal equations: A^T A squares the
+            # condition number, and BSA readbacks can carry offsets (TMIT ~1e9)
+            # that would otherwise swamp the quadratic term's digits
+            mx = x.mean()
+            u = x - mx
+            u2 = u*u
+            s1, s2, s3, s4 = u.sum(), u2.sum(), (u2*u).sum(), (u2*u2).sum()
+            A = array([[s4, s3, s2], [s3, s2, s1], [s2, s1, u.size]])
+            b = array([(u2*y).sum(), (u*y).sum(), y.sum()])
+            a2, a1, a0 = solve(A, b)
+            # shift back from u = x - mx to x
+            coeffs = array([a2, a1 - 2.0*a2*mx, a0 - a1*mx + a2*mx*mx])
+        else:
+            return polyfit(x, y, order)
+    except LinAlgError:
+        return polyfit(x, y, order)
+    # degenerate inputs (stuck channel, too few distinct x values) give a
+    # singular system -- 0/0 slopes or solve() garbage -- where polyfit's
+    # lstsq path still degrades gracefully, so hand those off to it
+    if not isfinite(coeffs).all():
+        return polyfit(x, y, order)
+    return coeffs
+
 
 class _rtbsaPlot(PlotWidget):
     """
@@ -74,6 +129,9 @@ class _rtbsaPlot(PlotWidget):
         self.getAxis('bottom').setTextPen('k')
         self.getAxis('left').setTextPen('k')
         self.showGrid(1, 1)
+        # only repaint the scene regions that changed, pyqtgraph's default
+        # FullViewportUpdate redraws the whole viewport on every data tick
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
 
         self._draw_timer = QTimer(self)
         self._draw_timer.setInterval(DEFAULT_DRAW_INTERVAL)
@@ -84,11 +142,17 @@ class _rtbsaPlot(PlotWidget):
 
     def kill_stream(self): raise NotImplementedError
 
+    def clear_data(self): raise NotImplementedError
+
     def stop_update(self): self._draw_timer.stop()
 
     def restart_update(self): self.stop_update(); self._draw_timer.start()
 
-    def _filter_outliers(self, B): return abs(B-nanmean(B)) < self.N_sigma*nanstd(B)
+    def _filter_outliers(self, B):
+        # reuse the demeaned residuals for both the std dev and the bound check,
+        # one pass over the buffer instead of separate nanmean + nanstd walks
+        d = B - nanmean(B)
+        return abs(d) < self.N_sigma*sqrt(nanmean(d*d))
 
 
 class rtbsaCorrPlot(_rtbsaPlot):
@@ -117,13 +181,24 @@ class rtbsaCorrPlot(_rtbsaPlot):
         self.fit_coeffs = None
         self.stream = dualBSAStreamBuffer(ch1, ch2, beamline=self.beamline)
         self._p_latest = -1
+        # scratch mask buffers, reused every frame by _update_data
+        self._mask = empty(BSA_BUFFER_LENGTH, dtype=bool)
+        self._mask_tmp = empty(BSA_BUFFER_LENGTH, dtype=bool)
+        # unit fit grid scaled into the data range each frame, avoids a
+        # fresh linspace allocation per update
+        self._grid01 = linspace(0.0, 1.0, FIT_LINE_NPTS)
+        self._xp = empty(FIT_LINE_NPTS)
 
         self._scatter = ScatterPlotItem(symbol='o', size=4)
         self._scatter.setBrush(QCOL_B)
         self._scatter.setOpacity(1.0)
+        # cache rendered items in item coordinates so pans/partial repaints
+        # reuse the raster instead of re-stroking every symbol
+        self._scatter.setCacheMode(QGraphicsItem.ItemCoordinateCache)
         self._show_fit = show_fit
         self._fit_line = PlotCurveItem(pen=QCOL_R)
         self._fit_line.setOpacity(0.0)
+        self._fit_line.setCacheMode(QGraphicsItem.ItemCoordinateCache)
         self._fit_text = LabelItem('', color=QCOL_R)
         self._fit_text.setParentItem(self.getPlotItem())
         self._fit_text.setOpacity(ANNOTATION_ALPHA)
@@ -136,6 +211,21 @@ class rtbsaCorrPlot(_rtbsaPlot):
 
     def kill_stream(self): self.stream.stop()
 
+    def clear_data(self):
+        """ blank the drawn data without detaching items from the scene """
+        self._scatter.setData([], [])
+        self._fit_line.setData([], [])
+        self._data_text.setText('')
+        self._fit_text.setText('')
+
+    def reset_channels(self, ch1, ch2):
+        """ swap the streamed PVs in place, reusing the existing Qt plot items """
+        if ch1 != self.stream.ch1: self.stream.ch1 = ch1
+        if ch2 != self.stream.ch2: self.stream.ch2 = ch2
+        self.clear_data()
+        self.getPlotItem().setLabel(axis='bottom', text=self.stream.ch1)
+        self.getPlotItem().setLabel(axis='left', text=self.stream.ch2)
+
     @property
     def show_fit(self): return self._show_fit
 
@@ -149,20 +239,29 @@ class rtbsaCorrPlot(_rtbsaPlot):
         # filters nans (and optionally outlier points) from raw buffer data 
         B, self._p_latest = self.stream.get_data()
         Bx, By = B[0,-1*self.N_pts:], B[1,-1*self.N_pts:]
-        mask = isfinite(Bx) & isfinite(By)
+        # evaluate the finite + outlier predicates into reused scratch buffers
+        # rather than allocating a fresh boolean temporary for each term
+        mask, tmp = self._mask[:Bx.size], self._mask_tmp[:Bx.size]
+        isfinite(Bx, out=mask)
+        isfinite(By, out=tmp)
+        logical_and(mask, tmp, out=mask)
         if self.filter_data:
-            mask = mask & self._filter_outliers(Bx) & self._filter_outliers(By)
-        self.N_pts_actual = sum(mask)
+            mask &= self._filter_outliers(Bx)
+            mask &= self._filter_outliers(By)
+        self.N_pts_actual = count_nonzero(mask)
         return Bx[mask], By[mask]
 
     def _update_plot(self):
+        # nobody is looking, skip the data pull/fit/redraw entirely
+        if not self.isVisible(): return
         x, y = self._update_data()
         self._scatter.setData(x, y)
         if self.show_fit:
-            self.fit_coeffs = polyfit(x, y, self.fit_order)
+            self.fit_coeffs = _fast_polyfit(x, y, self.fit_order)
             yp = poly1d(self.fit_coeffs)
-            xp = linspace(min(x), max(x), FIT_LINE_NPTS)
-            self._fit_line.setData(xp, yp(xp))
+            lo, hi = x.min(), x.max()
+            self._xp[:] = lo + (hi - lo)*self._grid01
+            self._fit_line.setData(self._xp, yp(self._xp))
         self._annotate()
 
     def _annotate(self):
@@ -210,11 +309,16 @@ class rtbsaTimePlot(_rtbsaPlot):
         _rtbsaPlot.__init__(self, **kw)
         self.__doc__ += f'\n{_rtbsaPlot.__doc__}'
         self.channel = channel
+        # the FFT redraws on its own slower timer, a full transform at the
+        # 10Hz scatter/line cadence is wasted work
+        self._fft_timer = QTimer(self)
+        self._fft_timer.setInterval(FFT_DRAW_INTERVAL)
+        self._fft_timer.timeout.connect(self._update_fft)
         self.plot_fft = plot_fft
         self.stream = BSAStreamBuffer(self.channel, self.beamline)
 
         self._raw_buffer = self.stream.get_data()
-        self._t = linspace(0, BSA_BUFFER_LENGTH, BSA_BUFFER_LENGTH)
+        self._t = _T_AXIS
         self._domain = None
         self._line = PlotCurveItem(pen=QCOL_B, antialias=True)
         self._line.setOpacity(1.0)
@@ -222,38 +326,71 @@ class rtbsaTimePlot(_rtbsaPlot):
 
     def kill_stream(self): self.stream.stop()
 
+    def clear_data(self):
+        """ blank the drawn data without detaching items from the scene """
+        self._line.setData([], [])
+        self._data_text.setText('')
+
+    def reset_channels(self, ch1, ch2=None):
+        """ swap the streamed PV in place, reusing the existing Qt plot items """
+        if ch1 != self.channel:
+            self.channel = ch1
+            self.stream.channel = ch1
+        self.clear_data()
+        self.plot_fft = self._plot_fft  # refreshes axis labels for the new channel
+
     @property
     def plot_fft(self): return self._plot_fft
     
     @plot_fft.setter
     def plot_fft(self, value):
         self._plot_fft = value
-        self.getPlotItem().setLabel(axis='bottom', text='frequency')
         xlabel, ylabel = 'shot index', self.channel
         if self.plot_fft:
             xlabel, ylabel = 'frequency [Hz]', f'power spectral density ({self.channel})'
         self.getPlotItem().setLabel(axis='bottom', text=xlabel)
         self.getPlotItem().setLabel(axis='left', text=ylabel)
+        if not value:
+            self._fft_timer.stop()
+        elif self._draw_timer.isActive():
+            self._fft_timer.start()
+
+    def stop_update(self):
+        self._fft_timer.stop()
+        _rtbsaPlot.stop_update(self)
+
+    def restart_update(self):
+        _rtbsaPlot.restart_update(self)
+        if self.plot_fft: self._fft_timer.start()
 
     def _update_data(self):
+        # slice down to the plotted tail first, so the mask/filter/fancy-index
+        # passes only touch the N_pts samples that can actually be drawn
         B, self._p_latest = self.stream.get_data()
-        mask = isfinite(B)
-        if self.filter_data: mask = mask & self._filter_outliers(B)
-        self.N_pts_actual = sum(mask)
-        self._raw_buffer = (B[mask])[-1*self.N_pts:]
-        tt = self._t[mask]
-        self._domain = tt[-1*self.N_pts:]
-        # self._domain = (self._t[-1*self.N_pts:])[mask]
+        B_tail = B[-1*self.N_pts:]
+        mask = isfinite(B_tail)
+        if self.filter_data: mask &= self._filter_outliers(B_tail)
+        self.N_pts_actual = count_nonzero(mask)
+        self._raw_buffer = B_tail[mask]
+        self._domain = self._t[-1*self.N_pts:][mask]
 
     def _update_plot(self):
+        # nobody is looking, skip the data pull/redraw entirely
+        if not self.isVisible(): return
+        if self.plot_fft: return  # FFT mode is driven by _fft_timer instead
         self._update_data()
-        x, y = self._domain, self._raw_buffer
-        if self.plot_fft:
-            psd = abs(fft(self._raw_buffer - nanmean(self._raw_buffer))**2)
-            f = fftfreq(self.N_pts_actual, self.stream.sample_spacing)
-            freq_domain = (f > 0)
-            x, y = f[freq_domain], psd[freq_domain]
-        self._line.setData(x, y)
+        self._line.setData(self._domain, self._raw_buffer)
+        self._annotate()
+
+    def _update_fft(self):
+        if not self.isVisible(): return
+        self._update_data()
+        # real-input rfft is ~2x the full fft and only returns nonnegative
+        # frequencies, so no (f > 0) mask pass is needed (just skip DC)
+        spec = rfft(self._raw_buffer - nanmean(self._raw_buffer))
+        psd = spec.real*spec.real + spec.imag*spec.imag
+        f = rfftfreq(self.N_pts_actual, self.stream.sample_spacing)
+        self._line.setData(f[1:], psd[1:])
         self._annotate()
 
     def get_annotation(self):
@@ -8,19 +8,73 @@ __author__ = 'Zack Buschmann <zack@slac.stanford.edu>'
 
 import os
 import sys
+import time
+import pickle
+import hashlib
+import tempfile
 from subprocess import check_output, CalledProcessError
 from socket import gethostname
-from PyQt5.QtCore import QTimer, Qt
+from collections import namedtuple
+from itertools import product
+from threading import Lock
+from PyQt5.QtCore import (
+    QTimer, Qt, QThread, QProcess, QObject, QRunnable, QThreadPool,
+    pyqtSignal, QStringListModel
+    )
 from PyQt5.QtWidgets import QVBoxLayout, QCompleter
+import pyqtgraph
 from pyqtgraph.exporters import ImageExporter
 
 from physicselog import submit_entry
 from meme.names import list_pvs
 from pydm import Display
-from pyqtRTBSAPlot import rtbsaCorrPlot, rtbsaTimePlot
+from pyqtRTBSAPlot import rtbsaCorrPlot, rtbsaTimePlot, FFT_BACKEND
+
+if FFT_BACKEND == 'numpy':
+    print('no accelerated FFT backend found (pyfftw/scipy), FFT mode will use numpy.fft')
 
 
 SELF_PATH = os.path.dirname(os.path.abspath(__file__))
+UI_PATH = os.path.join(SELF_PATH, 'rtbsa.ui')
+
+# facility identity is fixed for the process lifetime, resolve it at import
+_F2_HOSTS = frozenset({'facet-srv01', 'facet-srv02'})
+IS_F2 = gethostname() in _F2_HOSTS
+
+# GPU rasterization of the continuously-updating plots, opt-in via --gl since
+# some console hosts only have (slow) software GL
+USE_OPENGL = '--gl' in sys.argv
+if USE_OPENGL:
+    pyqtgraph.setConfigOptions(useOpenGL=True, enableExperimental=True, antialias=False)
+
+# BSA namelist plus a name -> row lookup, so default-channel selection is O(1)
+# instead of a linear scan over thousands of PV names
+PVList = namedtuple('PVList', ['names', 'index'])
+
+PV_LIST_CACHE_DIR = os.path.expanduser('~/.cache/rtbsa')
+PV_LIST_CACHE_TTL = 86400  # BSA namelists change rarely, refresh daily
+
+# namelists shared by every rtbsaGUI instance in the process, filled by the
+# background fetchers (the disk cache above covers cross-process sharing)
+_BSA_PV_LISTS = {}
+_BSA_PV_LOCK = Lock()
+
+
+def _cached_list_pvs(tag, ttl=PV_LIST_CACHE_TTL):
+    # memoize the (slow) meme/names RPC on disk so repeat GUI launches and
+    # first-time beamline toggles skip the network round trip
+    os.makedirs(PV_LIST_CACHE_DIR, exist_ok=True)
+    fname = os.path.join(PV_LIST_CACHE_DIR, hashlib.sha1(tag.encode()).hexdigest())
+    try:
+        if time.time() - os.path.getmtime(fname) < ttl:
+            with open(fname, 'rb') as f: return pickle.load(f)
+    except (OSError, pickle.PickleError):
+        pass
+    pvs = list_pvs('%', tag=tag)
+    tmpname = f'{fname}.{os.getpid()}'
+    with open(tmpname, 'wb') as f: pickle.dump(pvs, f)
+    os.replace(tmpname, fname)  # atomic, concurrent GUIs can't corrupt the cache
+    return pvs
 
 LCLS_DEAFULT_BEAMLINE = 'NC_HXR'
 DEFAULT_CHANNELS = {
@@ -60,106 +114,236 @@ STYLE_CLEAR_OFF = TEXT_OFF
 STYLE_LOG_ON = STYLE_ROOT_ON.format(BG_LOG)
 STYLE_LOG_OFF = STYLE_ROOT_OFF.format(BG_LOG)
 
+def _render_plot_image(plotitem):
+    # rasterize to a QImage -- the scene is mutated by the draw timers, so
+    # this must run on the GUI thread; it only takes a few milliseconds
+    return ImageExporter(plotitem).export(toBytes=True)
+
+
+def _write_plot_png(img):
+    # save under a unique temp path so concurrent GUIs on a shared host
+    # can't clobber each other's image (callers own the file and should
+    # remove it when done)
+    fd, path = tempfile.mkstemp(prefix='RTBSA_', suffix='.png')
+    os.close(fd)
+    img.save(path, 'PNG')
+    return path
+
+
+def _build_button_qss(start_en, stop_en, clear_en, log_en):
+    # one object-name-scoped sheet for all five control buttons, so a state
+    # change repolishes in a single pass instead of five widget-level cascades
+    s_start = STYLE_START_ON if start_en else STYLE_START_OFF
+    s_stop = STYLE_STOP_ON if stop_en else STYLE_STOP_OFF
+    s_clear = STYLE_CLEAR_ON if clear_en else STYLE_CLEAR_OFF
+    s_log = STYLE_LOG_ON if log_en else STYLE_LOG_OFF
+    return '\n'.join([
+        f'QPushButton#startButton {{ {s_start} }}',
+        f'QPushButton#stopButton {{ {s_stop} }}',
+        f'QPushButton#clearButton {{ {s_clear} }}',
+        f'QPushButton#physLogButton {{ {s_log} }}',
+        f'QPushButton#mccLogButton {{ {s_log} }}',
+        ])
+
+# all 16 enable-state combinations, precomputed at import so button state
+# changes do no string work at all
+BUTTON_QSS_TABLE = {key: _build_button_qss(*key) for key in product((False, True), repeat=4)}
+
 # facility-dependent colors for the window banner
 BANNER_NC = 'background-color: rgb(0, 170, 255);'
 BANNER_SC = 'background-color: rgb(255, 55, 95);'
 BANNER_F2 = 'background-color: rgb(255, 149, 60);'
 BANNERS = {'NC':BANNER_NC, 'SC':BANNER_SC, 'F2':BANNER_F2}
 
+# facility-dependent physics elog names
+LOGNAMES = {'NC':'lcls', 'SC':'lcls2', 'F2':'facet'}
+
+class _PVListFetcher(QThread):
+    """ background worker that retrieves one beamline's BSA namelist """
+    fetched = pyqtSignal(str, list)
+
+    def __init__(self, beamline, parent=None):
+        QThread.__init__(self, parent)
+        self._beamline = beamline
+
+    def run(self):
+        with _BSA_PV_LOCK:
+            pvs = _BSA_PV_LISTS.get(self._beamline)
+        if pvs is None:
+            try:
+                pvs = _cached_list_pvs(BSA_NAMELISTS[self._beamline])
+            except Exception as e:
+                print(repr(e))
+                pvs = []
+            if pvs:
+                with _BSA_PV_LOCK:
+                    _BSA_PV_LISTS[self._beamline] = pvs
+        self.fetched.emit(self._beamline, pvs)
+
+
+class _LogSubmitter(QRunnable):
+    """ writes an already-rendered plot image and submits the elog entry
+        off the GUI thread (QImage is a value type, safe to hand over) """
+    class _Signals(QObject):
+        done = pyqtSignal(str)
+
+    def __init__(self, image, submit_kwargs):
+        QRunnable.__init__(self)
+        self._image = image
+        self._submit_kwargs = submit_kwargs
+        self.signals = self._Signals()
+
+    def run(self):
+        path = None
+        try:
+            path = _write_plot_png(self._image)
+            submit_entry(attachment=path, **self._submit_kwargs)
+            msg = f'Sent to {self._submit_kwargs["logbook"]} physics elog'
+        except Exception as e:
+            print(repr(e))
+            msg = 'Physics elog submission failed'
+        if path:
+            try: os.remove(path)
+            except OSError: pass
+        self.signals.done.emit(msg)
+
+
 class rtbsaGUI(Display):
     def __init__(self, parent=None, args=None):
         Display.__init__(self, parent=parent, args=args)
 
+        self._bl_buttons = {
+            'NC_SXR':  self.bl_NC_SXR,
+            'NC_HXR':  self.bl_NC_HXR,
+            'SC_BSYD': self.bl_SC_BSYD,
+            'SC_SXR':  self.bl_SC_SXR,
+            'SC_HXR':  self.bl_SC_HXR,
+            'F2':      self.bl_F2,
+            }
+
         # disable beamline toggles for lcls/facet as needed
-        is_F2 = (gethostname() in ['facet-srv01', 'facet-srv02'])
-        self.bl_NC_SXR.setEnabled(not is_F2)
-        self.bl_NC_HXR.setEnabled(not is_F2)
-        self.bl_SC_BSYD.setEnabled(not is_F2)
-        self.bl_SC_SXR.setEnabled(not is_F2)
-        self.bl_SC_HXR.setEnabled(not is_F2)
-        self.bl_F2.setEnabled(is_F2)
+        is_F2 = IS_F2
+        for bl, btn in self._bl_buttons.items():
+            btn.setEnabled((bl == 'F2') == is_F2)
         self.bl_F2.setChecked(is_F2)
         if is_F2:
             self.beamline = 'F2'
         else:
             self.beamline = LCLS_DEAFULT_BEAMLINE
 
-        # container for BSA PVs, only populate as needed
+        # container for BSA PVs, populated by background fetchers
         self.bsa_PV_lists = {}
         for bl in BEAMLINES: self.bsa_PV_lists[bl] = None
+        self._pv_fetchers = {}
+        # one prebuilt item model per beamline, combo boxes swap between them
+        self._bl_models = {}
+        # warm every beamline's namelist once the event loop is idle
+        QTimer.singleShot(0, self._prefetch_PV_lists)
 
         self.plotcontainer.setLayout(QVBoxLayout())
         self.plot, self.mode, self.need_reinit = None, DEFAULT_PLOT_MODE, False
+        self._updating_combos = False
+        self._reinit_pending = False
+        self._pending_status = None
         self.init_plot(
             DEFAULT_CHANNELS[self.beamline][0], DEFAULT_CHANNELS[self.beamline][1], self.beamline
             )
         self.set_beamline()
 
+        # connected once for the GUI lifetime, _populate_PV_selectors raises
+        # _updating_combos instead of churning disconnect/reconnect
+        self.pvsel_1.activated.connect(self._schedule_reinit)
+        self.pvsel_2.activated.connect(self._schedule_reinit)
         self.startButton.clicked.connect(self.restart_plot)
         self.stopButton.clicked.connect(self.stop_plot)
         self.clearButton.clicked.connect(self.clear_plot)
         self.physLogButton.clicked.connect(self.log_plot_phys)
         self.mccLogButton.clicked.connect(self.log_plot_mcc)
-        for bl_ctrl in [
-            self.bl_NC_SXR, self.bl_NC_HXR, self.bl_SC_BSYD,
-            self.bl_SC_SXR, self.bl_SC_HXR, self.bl_F2
-            ]:
+        for bl_ctrl in self._bl_buttons.values():
             bl_ctrl.clicked.connect(self.set_beamline)
         for mode_ctrl in [
             self.plotmode_corr,  self.plotmode_time,  self.plotmode_fft
             ]:
             mode_ctrl.clicked.connect(self.set_plotmode)
-        self.setNpts.valueChanged.connect(self.set_filtering)
-        self.set_filt.clicked.connect(self.set_filtering)
-        self.set_Nsigma.valueChanged.connect(self.set_filtering)
-        self.set_fit.clicked.connect(self.set_fitting)
-        self.sel_fitord.valueChanged.connect(self.set_fitting)
+        # the signals already carry the new value, write it straight onto the
+        # plot instead of re-reading every control in a catch-all slot
+        self.setNpts.valueChanged.connect(lambda v: setattr(self.plot, 'N_pts', v))
+        self.set_filt.clicked.connect(lambda on: setattr(self.plot, 'filter_data', on))
+        self.set_Nsigma.valueChanged.connect(lambda v: setattr(self.plot, 'N_sigma', v))
+        self.set_fit.clicked.connect(lambda on: setattr(self.plot, 'show_fit', on))
+        self.sel_fitord.valueChanged.connect(lambda v: setattr(self.plot, 'fit_order', v))
 
         self.sel_fitord.setValue(1)
         self.toggle_stop_start(True)
         self.toggle_clear_log(False)
         self.status.setText('Hello world!')
 
-    def ui_filename(self): return os.path.join(SELF_PATH, 'rtbsa.ui')
+    def ui_filename(self): return UI_PATH
 
     def set_beamline(self):
-        if   self.bl_NC_SXR.isChecked(): self.beamline = 'NC_SXR'
-        elif self.bl_NC_HXR.isChecked(): self.beamline = 'NC_HXR'
-        elif self.bl_SC_BSYD.isChecked(): self.beamline = 'SC_BSYD'
-        elif self.bl_SC_SXR.isChecked(): self.beamline = 'SC_SXR'
-        elif self.bl_SC_HXR.isChecked(): self.beamline = 'SC_HXR'
-        elif self.bl_F2.isChecked(): self.beamline = 'F2'
-
+        self.beamline = next(
+            bl for bl, btn in self._bl_buttons.items() if btn.isChecked()
+            )
         self.banner.setStyleSheet(BANNERS[self.beamline[:2]])
-        self.get_BSA_PVs()
+        if self.bsa_PV_lists[self.beamline] is None:
+            # fetch off-thread and populate once the namelist arrives,
+            # blocking here would freeze the whole UI for the RPC duration
+            self.status.setText('Updating BSA PV list ...')
+            self._fetch_PV_list(self.beamline)
+            return
+        self._populate_PV_selectors()
+
+    def _prefetch_PV_lists(self):
+        for bl in BEAMLINES: self._fetch_PV_list(bl)
+
+    def _fetch_PV_list(self, beamline):
+        if self.bsa_PV_lists[beamline] is not None or beamline in self._pv_fetchers:
+            return
+        with _BSA_PV_LOCK:
+            pvs = _BSA_PV_LISTS.get(beamline)
+        if pvs is not None:
+            # another window in this process already fetched the namelist
+            self._on_PV_list_ready(beamline, pvs)
+            return
+        fetcher = _PVListFetcher(beamline, parent=self)
+        fetcher.fetched.connect(self._on_PV_list_ready)
+        self._pv_fetchers[beamline] = fetcher
+        fetcher.start()
+
+    def _on_PV_list_ready(self, beamline, pvs):
+        self._pv_fetchers.pop(beamline, None)
+        if not pvs:
+            # left as None so the next beamline toggle retries the fetch
+            if beamline == self.beamline:
+                self.status.setText('Failed to get BSA device list. Toggle beamline to retry.')
+            return
+        self.bsa_PV_lists[beamline] = PVList(
+            pvs, {name: i for i, name in enumerate(pvs)}
+            )
+        self._bl_models[beamline] = QStringListModel(pvs, self)
+        if beamline == self.beamline:
+            self._populate_PV_selectors()
+
+    def _populate_PV_selectors(self):
+        pvlist = self.bsa_PV_lists[self.beamline]
+        model = self._bl_models[self.beamline]
+        # suppress reinit while the dropdown menus are being repopulated
+        self._updating_combos = True
         for pvsel in [self.pvsel_1, self.pvsel_2]:
-            # disable callbacks while updating dropdown menus
-            pvsel.disconnect()
-            pvsel.clear()
-            pvsel.addItems(self.bsa_PV_lists[self.beamline])
+            # swap the prebuilt model in instead of clear() + addItems(),
+            # which fires per-item model signals over thousand-entry lists
+            pvsel.setModel(model)
             # comboBox QCompleter settings make dropdown lists searchable
             pvsel.completer().setCompletionMode(QCompleter.PopupCompletion)
             pvsel.completer().setFilterMode(Qt.MatchContains)
-            pvsel.activated.connect(self.reinit_plot)
-        self.pvsel_1.setCurrentIndex(
-            self.bsa_PV_lists[self.beamline].index(DEFAULT_CHANNELS[self.beamline][0])
-            )
-        self.pvsel_2.setCurrentIndex(
-            self.bsa_PV_lists[self.beamline].index(DEFAULT_CHANNELS[self.beamline][1])
-            )
-        self.reinit_plot()
-        self.status.setText(f'Set beamline to: {self.beamline}')
-
-    def get_BSA_PVs(self):
-        if not self.bsa_PV_lists[self.beamline]:
-            self.status.setText('Updating BSA PV list ...')
-            try:
-                self.bsa_PV_lists[self.beamline] = list_pvs('%', tag=BSA_NAMELISTS[self.beamline])
-            except Exception as e:
-                print(repr(e))
-                self.status.setText('Failed to get BSA device list. Toggle beamline to retry.')
-                self.bsa_PV_lists[self.beamline] = ['']
-        return self.bsa_PV_lists[self.beamline]
+        self.pvsel_1.setCurrentIndex(pvlist.index[DEFAULT_CHANNELS[self.beamline][0]])
+        self.pvsel_2.setCurrentIndex(pvlist.index[DEFAULT_CHANNELS[self.beamline][1]])
+        self._updating_combos = False
+        self._schedule_reinit()
+        # shown now and re-applied after the deferred reinit, whose stop_plot
+        # would otherwise overwrite it with 'Plot updating stopped.'
+        self._pending_status = f'Set beamline to: {self.beamline}'
+        self.status.setText(self._pending_status)
 
     def set_plotmode(self):
         is_corr_plot = self.plotmode_corr.isChecked()
@@ -172,7 +356,7 @@ class rtbsaGUI(Display):
             self.mode = 'time'
         else:
             self.mode = 'fft'
-        self.reinit_plot()
+        self._schedule_reinit()
 
     def init_plot(self, ch1, ch2, beamline):
         if self.plot:
@@ -182,12 +366,42 @@ class rtbsaGUI(Display):
             self.plot = rtbsaCorrPlot(ch1=ch1, ch2=ch2, beamline=beamline, start_paused=True)
         else:
             self.plot = rtbsaTimePlot(channel=ch1, beamline=beamline, plot_fft=(self.mode=='fft'))
-        self.plot.N_pts = self.setNpts.value()
+        # a fresh plot needs the full control state, later tweaks stream in
+        # through the per-control setters
+        self.set_filtering()
+        if self.mode == 'corr': self.set_fitting()
         self.ui.plotcontainer.layout().addWidget(self.plot)
 
+    def _schedule_reinit(self):
+        # coalesce signal bursts (one user action can fire combo, beamline,
+        # and mode handlers together) into a single rebuild per event pass
+        if self._reinit_pending: return
+        self._reinit_pending = True
+        QTimer.singleShot(0, self._do_reinit)
+
+    def _do_reinit(self):
+        self._reinit_pending = False
+        self.reinit_plot()
+        # restore any confirmation queued by the handler that scheduled this
+        # rebuild, so it stays the last message the operator sees
+        if self._pending_status:
+            self.status.setText(self._pending_status)
+            self._pending_status = None
+
     def reinit_plot(self):
+        if self._updating_combos: return
         self.stop_plot()
         ch1, ch2 = self.pvsel_1.currentText(), self.pvsel_2.currentText()
+        # same-mode changes reuse the existing widget + scene state, a full
+        # teardown is only needed when the plot type or beamline changes
+        if self.plot and self.plot.beamline == self.beamline:
+            if self.mode == 'corr' and isinstance(self.plot, rtbsaCorrPlot):
+                self.plot.reset_channels(ch1, ch2)
+                return
+            if self.mode != 'corr' and isinstance(self.plot, rtbsaTimePlot):
+                self.plot.plot_fft = (self.mode == 'fft')
+                self.plot.reset_channels(ch1)
+                return
         self.init_plot(ch1, ch2, self.beamline)
 
     def set_filtering(self):
@@ -216,7 +430,9 @@ class rtbsaGUI(Display):
 
     def clear_plot(self):
         self.stop_plot()
-        self.plot.clear()
+        # blank the data only -- PlotWidget.clear() would detach the plot
+        # items, which the same-mode reinit path reuses
+        self.plot.clear_data()
         self.ui.status.setText('Plot cleared.')
         self.toggle_clear_log(False)
         self.need_reinit = True
@@ -233,24 +449,16 @@ class rtbsaGUI(Display):
         self.set_button_styles()
 
     def set_button_styles(self):
-        s_start = STYLE_START_ON if self.ui.startButton.isEnabled() else STYLE_START_OFF
-        s_stop = STYLE_STOP_ON if self.ui.stopButton.isEnabled() else STYLE_STOP_OFF
-        s_clear = STYLE_CLEAR_ON if self.ui.clearButton.isEnabled() else STYLE_CLEAR_OFF
-        s_log = STYLE_LOG_ON if self.ui.physLogButton.isEnabled() else STYLE_LOG_OFF
-        self.ui.startButton.setStyleSheet(s_start)
-        self.ui.stopButton.setStyleSheet(s_stop)
-        self.ui.clearButton.setStyleSheet(s_clear)
-        self.ui.physLogButton.setStyleSheet(s_log)
-        self.ui.mccLogButton.setStyleSheet(s_log)
-
-    def _save_plot(self): ImageExporter(self.plot.getPlotItem()).export('/tmp/RTBSA.png')
+        key = (
+            self.ui.startButton.isEnabled(), self.ui.stopButton.isEnabled(),
+            self.ui.clearButton.isEnabled(), self.ui.physLogButton.isEnabled(),
+            )
+        self.setStyleSheet(BUTTON_QSS_TABLE[key])
+
+    def _save_plot(self): return _write_plot_png(_render_plot_image(self.plot.getPlotItem()))
 
     def log_plot_phys(self):
-        self._save_plot()
-        facility = self.beamline[:2]
-        if   facility == 'NC': logname = 'lcls'
-        elif facility == 'SC': logname = 'lcls2'
-        else: logname = 'facet'
+        logname = LOGNAMES[self.beamline[:2]]
         if self.mode == 'corr':
             s1, s2 = self.plot.get_annotations()
             logtxt = f'{s1}\n{s2}'
@@ -260,17 +468,37 @@ class rtbsaGUI(Display):
             if self.mode == 'fft': d2 = 'FFT'
             desc = f'{d1} {d2}'
             logtxt = self.plot.get_annotation()
-        
-        submit_entry(
-            logbook=logname, username='Real-time BSA GUI',
-            title=f'{self.beamline} BSA data: {desc}',
-            entry_text=logtxt, attachment='/tmp/RTBSA.png'
+
+        # the scene snapshot is taken here on the GUI thread (the draw timer
+        # mutates it, and the plot itself can be torn down by a reinit), then
+        # only the PNG write + upload run on a pool worker
+        job = _LogSubmitter(
+            _render_plot_image(self.plot.getPlotItem()),
+            dict(
+                logbook=logname, username='Real-time BSA GUI',
+                title=f'{self.beamline} BSA data: {desc}', entry_text=logtxt
+                ),
             )
-        self.status.setText(f'Sent to {logname} physics elog')
+        job.signals.done.connect(self.status.setText)
+        QThreadPool.globalInstance().start(job)
+        self.status.setText(f'Sending to {logname} physics elog ...')
 
     def log_plot_mcc(self):
-        self._save_plot()
-        os.system(f'lpr -P elog_mcc /tmp/RTBSA.png')
-        self.status.setText('Sent to MCC E-log')
+        path = self._save_plot()
+        # QProcess returns immediately, os.system forked a shell and blocked
+        # the event loop until lpr finished
+        p = QProcess(self)
+        def _cleanup(msg):
+            self.status.setText(msg)
+            if os.path.exists(path): os.remove(path)
+        def _done(*_):
+            ok = p.exitStatus() == QProcess.NormalExit and p.exitCode() == 0
+            _cleanup('Sent to MCC E-log' if ok else 'MCC E-log submission failed')
+        # errorOccurred catches lpr failing to start at all, in which case
+        # finished never fires and the temp file would otherwise leak
+        p.finished.connect(_done)
+        p.errorOccurred.connect(lambda *_: _cleanup('MCC E-log submission failed'))
+        p.start('lpr', ['-P', 'elog_mcc', path])
+        self.status.setText('Sending to MCC E-log ...')
 
     